@@ -3,21 +3,31 @@ import os
 import io
 from PIL import Image
 import html
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 
 from google import genai
 from google.genai import types
 
-import pdfplumber
-from docx import Document
-
 # ---- Setup client ----
 API_KEY = st.secrets.get("GEMINI_API_KEY") or os.getenv("GEMINI_API_KEY")
 if not API_KEY:
     st.error("No GEMINI_API_KEY found. Add it in Streamlit Secrets (GEMINI_API_KEY).")
     st.stop()
 
-client = genai.Client(api_key=API_KEY)
+@st.cache_resource
+def get_gemini_client(api_key: str) -> genai.Client:
+    """Create the Gemini client once per process and reuse it across reruns."""
+    return genai.Client(api_key=api_key)
+
+client = get_gemini_client(API_KEY)
 MODEL_ID = "gemini-1.5-flash"
+MAX_CONTEXT_CHARS = 12000  # cap on notes text sent with each prompt
+PREVIEW_SIZE = (1024, 1024)  # max size of the on-page image preview
+REPLY_CACHE_SIZE = 128  # recent replies kept in memory, shared by all sessions
+REPLY_CACHE_TTL = 3600  # seconds
 
 # --- Title ---
 st.title("🎓 Smart Study Buddy")
@@ -27,25 +37,57 @@ if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 if "file_content" not in st.session_state:
     st.session_state.file_content = ""
+if "last_image_id" not in st.session_state:
+    st.session_state.last_image_id = None
+
+# --- File helpers (cached across reruns) ---
+@st.cache_data(show_spinner=False)
+def extract_notes(file_bytes: bytes, filename: str) -> str:
+    """Extract plain text from uploaded notes (txt / pdf / docx)."""
+    name = filename.lower()
+    # Parser imports are local so a session that never uploads notes skips them
+    if name.endswith(".pdf"):
+        import pymupdf
+
+        # Keep MuPDF from printing a warning per malformed object while parsing
+        pymupdf.TOOLS.mupdf_display_errors(False)
+        pymupdf.TOOLS.mupdf_display_warnings(False)
+        # Serial on purpose: PyMuPDF holds the GIL and is not thread-safe per document
+        with pymupdf.open(stream=file_bytes, filetype="pdf") as doc:
+            return "\n\n".join(p.get_text("text") for p in doc).strip()
+    elif name.endswith(".txt"):
+        return file_bytes.decode("utf-8", errors="ignore")
+    else:
+        from docx import Document
+
+        doc = Document(io.BytesIO(file_bytes))
+        return "\n".join(p.text for p in doc.paragraphs).strip()
+
+@st.cache_data(show_spinner=False)
+def load_image(image_bytes: bytes) -> Image.Image:
+    """Decode uploaded image bytes into a downscaled PIL image for the preview."""
+    pil_img = Image.open(io.BytesIO(image_bytes))
+    pil_img.draft("RGB", PREVIEW_SIZE)  # JPEG: let libjpeg decode at reduced scale
+    pil_img.thumbnail(PREVIEW_SIZE, Image.Resampling.LANCZOS)
+    return pil_img
+
+def prepare_context(text: str, max_chars: int = MAX_CONTEXT_CHARS) -> str:
+    """Trim notes to at most max_chars, preferring a paragraph break in the second half."""
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind("\n\n", 0, max_chars)
+    if cut < max_chars // 2:
+        cut = max_chars  # an early break would discard most of the budget
+    return text[:cut].rstrip()
 
 # --- Upload notes (txt / pdf / docx) ---
 uploaded_file = st.file_uploader("📂 Upload your study notes (.txt, .pdf, .docx)", type=["txt", "pdf", "docx"])
 if uploaded_file is not None:
     try:
-        file_bytes = uploaded_file.read()
-        mime = uploaded_file.type or ""
-        if "pdf" in mime or uploaded_file.name.lower().endswith(".pdf"):
-            with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-                pages = [p.extract_text() or "" for p in pdf.pages]
-            text = "\n\n".join(pages).strip()
-        elif "plain" in mime or uploaded_file.name.lower().endswith(".txt"):
-            text = file_bytes.decode("utf-8", errors="ignore")
-        else:
-            doc = Document(io.BytesIO(file_bytes))
-            text = "\n".join([p.text for p in doc.paragraphs]).strip()
-
-        st.session_state.file_content = text
+        st.session_state.file_content = extract_notes(uploaded_file.getvalue(), uploaded_file.name)
         st.success("✅ File processed successfully!")
+        if len(st.session_state.file_content) > MAX_CONTEXT_CHARS:
+            st.info(f"ℹ️ Your notes are long, so only the first {MAX_CONTEXT_CHARS:,} characters are used as reference.")
     except Exception as e:
         st.error(f"Failed to process uploaded file: {e}")
 
@@ -54,8 +96,8 @@ uploaded_image = st.file_uploader("🖼️ Upload an image (jpg, png)", type=["j
 image_bytes = None
 if uploaded_image is not None:
     try:
-        image_bytes = uploaded_image.read()
-        pil_img = Image.open(io.BytesIO(image_bytes))
+        image_bytes = uploaded_image.getvalue()
+        pil_img = load_image(image_bytes)
         st.image(pil_img, caption="Uploaded image", use_container_width=True)
     except Exception as e:
         st.error(f"Failed to read image: {e}")
@@ -71,17 +113,66 @@ mode = st.radio("Choose a study mode:", ["Explain", "Quiz", "Review"], horizonta
 # --- Chat Input ---
 user_input = st.chat_input("Type your question or topic...")
 
-def call_gemini(prompt_text, image_bytes=None):
-    """Call Gemini API (with optional image)."""
+@st.cache_resource
+def get_reply_cache():
+    """Process-wide LRU of Gemini replies keyed on (model, prompt hash, image hash)."""
+    return {"lock": threading.Lock(), "items": OrderedDict()}
+
+def cache_get(key):
+    """Return a cached reply that is still fresh, or None."""
+    cache = get_reply_cache()
+    with cache["lock"]:
+        entry = cache["items"].get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > REPLY_CACHE_TTL:
+            del cache["items"][key]
+            return None
+        cache["items"].move_to_end(key)
+        return entry[1]
+
+def cache_put(key, reply):
+    """Store a reply, evicting the least recently used ones beyond REPLY_CACHE_SIZE."""
+    cache = get_reply_cache()
+    with cache["lock"]:
+        cache["items"][key] = (time.monotonic(), reply)
+        cache["items"].move_to_end(key)
+        while len(cache["items"]) > REPLY_CACHE_SIZE:
+            cache["items"].popitem(last=False)
+
+def stream_preview(mode, reply):
+    """Text shown while a reply streams; Quiz answers stay hidden until the final render."""
+    if mode != "Quiz":
+        return reply
+    questions = [q.split("A:", 1)[0].strip() for q in reply.split("Q:")[1:]]
+    return "\n\n".join(f"Q: {q}" for q in questions if q) or "📝 Generating quiz..."
+
+def call_gemini(prompt_text, mode, placeholder, image_bytes=None):
+    """Stream a Gemini reply (with optional image) into placeholder, reusing cached replies."""
+    prompt_sha = hashlib.sha256(prompt_text.encode()).hexdigest()
+    image_sha = hashlib.sha256(image_bytes).hexdigest() if image_bytes else None
+    key = (MODEL_ID, prompt_sha, image_sha)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached
+
     try:
         if image_bytes:
             mime = uploaded_image.type if uploaded_image is not None else "image/jpeg"
             image_part = types.Part.from_bytes(data=image_bytes, mime_type=mime)
             contents = [image_part, prompt_text]
-            response = client.models.generate_content(model=MODEL_ID, contents=contents)
         else:
-            response = client.models.generate_content(model=MODEL_ID, contents=prompt_text)
-        return response.text
+            contents = prompt_text
+
+        reply = ""
+        for chunk in client.models.generate_content_stream(model=MODEL_ID, contents=contents):
+            if chunk.text:
+                reply += chunk.text
+                placeholder.markdown(render_bubble("Bot", stream_preview(mode, reply)), unsafe_allow_html=True)
+        if not reply:  # e.g. a safety block or an empty candidate
+            return "⚠️ No response was generated. Try rephrasing your question."
+        cache_put(key, reply)  # only complete replies are cached, never errors
+        return reply
 
     except Exception as e:
         error_msg = str(e)
@@ -92,16 +183,62 @@ def call_gemini(prompt_text, image_bytes=None):
         else:
             return f"⚠️ Something went wrong: {error_msg}"
 
+def render_bubble(role, msg):
+    """Build the chat bubble HTML for a message (done once, when it is added)."""
+    safe_msg = html.escape(msg).replace("\n", "<br>")  # escape HTML + keep line breaks
+    if role == "You":
+        return f"""<div style='text-align:right; background:#DCF8C6; color:#000000;
+                 padding:10px; border-radius:12px; margin:6px;
+                 max-width:85%; float:right; clear:both;'>
+                 <b>🧑 You:</b><br>{safe_msg}</div>"""
+    return f"""<div style='text-align:left; background:#F1F0F0; color:#000000;
+                 padding:10px; border-radius:12px; margin:6px;
+                 max-width:85%; float:left; clear:both;'>
+                 <b>🤖 Bot:</b><br>{safe_msg}</div>"""
+
+def show_message(role, msg, bubble):
+    """Render one chat history entry."""
+    if role == "Bot" and mode == "Quiz" and "Q:" in msg:
+        # Special formatting for quizzes
+        questions = [q.strip() for q in msg.split("Q:") if q.strip()]
+        for q in questions:
+            if "A:" in q:
+                q_text, a_text = q.split("A:", 1)
+                st.markdown(f"** {q_text.strip()}**")
+                with st.expander("Reveal Answer"):
+                    st.markdown(f"<b>Answer:</b><br>{html.escape(a_text.strip()).replace(chr(10), '<br>')}",
+                                unsafe_allow_html=True)
+            else:
+                st.markdown(f"** {q.strip()}**")
+    else:
+        st.markdown(bubble, unsafe_allow_html=True)
+
+def add_message(role, msg):
+    """Append a message to the chat history together with its rendered bubble."""
+    entry = (role, msg, render_bubble(role, msg))
+    st.session_state.chat_history.append(entry)
+    return entry
+
+# --- Chat Display ---
+for entry in st.session_state.chat_history:
+    role, msg, *bubble = entry  # sessions from before bubbles were stored hold (role, msg)
+    show_message(role, msg, bubble[0] if bubble else render_bubble(role, msg))
+
 # --- Handle input ---
-if user_input or image_bytes:
+# The uploaded image stays put across reruns, so only treat it as a new
+# request until it has been answered; chat_input already fires once per send.
+image_id = uploaded_image.file_id if image_bytes else None
+new_image = image_id is not None and image_id != st.session_state.last_image_id
+
+if user_input or new_image:
     if user_input:
-        st.session_state.chat_history.append(("You", user_input))
+        show_message(*add_message("You", user_input))
         query_text = user_input
     else:
-        st.session_state.chat_history.append(("You", "📷 Sent an image"))
+        show_message(*add_message("You", "📷 Sent an image"))
         query_text = "Please describe and explain this image, and give 2 short flashcards."
 
-    context = st.session_state.file_content
+    context = prepare_context(st.session_state.file_content)
     if mode == "Explain":
         prompt = f"""
         You are a patient teacher. Explain step by step in simple words,
@@ -135,42 +272,16 @@ if user_input or image_bytes:
         Reference notes: {context}
         """
 
+    # New turns render below the history; the reply streams into one slot
+    placeholder = st.empty()
     with st.spinner("⏳ Thinking..."):
-         reply = call_gemini(prompt, image_bytes=image_bytes)
+         reply = call_gemini(prompt, mode, placeholder, image_bytes=image_bytes)
 
-    st.session_state.chat_history.append(("Bot", reply))
+    with placeholder.container():
+        show_message(*add_message("Bot", reply))
 
-# --- Chat Display ---
-for role, msg in st.session_state.chat_history:
-    safe_msg = html.escape(msg).replace("\n", "<br>")  # escape HTML + keep line breaks
+    # Mark the image handled only after a real reply (all failures start with ⚠️),
+    # so an error or a rerun that interrupts the stream sends it again
+    if image_id is not None and not reply.startswith("⚠️"):
+        st.session_state.last_image_id = image_id
 
-    if role == "You":
-        st.markdown(
-            f"""<div style='text-align:right; background:#DCF8C6; color:#000000;
-                 padding:10px; border-radius:12px; margin:6px;
-                 max-width:85%; float:right; clear:both;'>
-                 <b>🧑 You:</b><br>{safe_msg}</div>""",
-            unsafe_allow_html=True
-        )
-    else:
-        if mode == "Quiz" and "Q:" in msg:
-            # Special formatting for quizzes
-            questions = [q.strip() for q in msg.split("Q:") if q.strip()]
-            for q in questions:
-                if "A:" in q:
-                    q_text, a_text = q.split("A:", 1)
-                    st.markdown(f"** {q_text.strip()}**")
-                    with st.expander("Reveal Answer"):
-                        st.markdown(f"<b>Answer:</b><br>{html.escape(a_text.strip()).replace(chr(10), '<br>')}",
-                                    unsafe_allow_html=True)
-                else:
-                    st.markdown(f"** {q.strip()}**")
-        else:
-            # Normal bot response
-            st.markdown(
-                f"""<div style='text-align:left; background:#F1F0F0; color:#000000;
-                     padding:10px; border-radius:12px; margin:6px;
-                     max-width:85%; float:left; clear:both;'>
-                     <b>🤖 Bot:</b><br>{safe_msg}</div>""",
-                unsafe_allow_html=True
-            )